@@ -15,15 +15,26 @@ import urllib.parse
 import threading
 from queue import Queue
 import multiprocessing
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 import mutagen.easymp4
 import mutagen.easyid3
 import mutagen.oggopus
 import mutagen.flac
 
-fileinfo = namedtuple('fileinfo', ['relpath', 'stat', 'duration', 'bitrate'])
+fileinfo = namedtuple('fileinfo', ['relpath', 'stat', 'duration', 'bitrate', 'playcount', 'rating'])
+# Totals of a group of tracks. bitrate is the average in kbps, rating the
+# average rating.
+libstats = namedtuple('libstats', ['tracks', 'size', 'duration', 'bitrate', 'playcount', 'rating'])
+# command(quality, outpath) returns the argument list of a process reading
+# WAV from stdin, which is piped from the decoder. bitrate(quality) estimates
+# the average bitrate in kbps, to project the size of a destination.
+encoderprofile = namedtuple('encoderprofile', ['name', 'ext', 'quality', 'command', 'threads', 'bitrate'])
+# command(inpath) returns the argument list of a process writing WAV to stdout.
+# When strict is set, any output on stderr is treated as a failed decode.
+decoderprofile = namedtuple('decoderprofile', ['name', 'command', 'strict', 'threads'])
 
-TMPDIR          = '/tmp'
 RHYTHMBOXDB     = os.path.expanduser('~/.local/share/rhythmbox/rhythmdb.xml')
 LOSSYFORMATS    = {'.mp3', '.m4a', '.ogg', '.oga', '.wma', '.mpc', '.opus'}
 LOSSLESSFORMATS = {'.flac', '.wav'}
@@ -41,27 +52,114 @@ IGNORE_FILE     = 'musicsync-ignore.txt'
 # for most circumstances (giving very good quality for a relatively low bitrate).
 AAC_QUALITY  = '0.25'
 OPUS_QUALITY = '65'
+FDKAAC_QUALITY = '2'   # VBR mode, ~80kbps stereo
+FFMPEG_AAC_QUALITY = '80k'
+LAME_QUALITY = '6'     # -V6, ~115kbps
+VORBIS_QUALITY = '1'   # ~80kbps
 LOSSY_EXT = '.m4a'
 MINIMUM_TRANSCODE_BITRATE = 320 # highest
 MAXPROCS = multiprocessing.cpu_count()
-
-tmp_number = 0
+# Number of finished jobs to measure at each concurrency level before deciding
+# whether adding another job improves throughput (by at least CALIBRATE_GAIN).
+CALIBRATE_JOBS = 4
+CALIBRATE_GAIN = 1.05
+# seconds between aggregate 'snapshot' events while transcoding
+SNAPSHOT_INTERVAL = 10
+# Removed files are recorded here, so they can be restored with undoRemove().
+REMOVE_MANIFEST = os.path.expanduser('~/.local/share/musicsync/removed.jsonl')
+# Unlinking is mostly waiting on the (possibly slow) device, so use more
+# threads than there are CPUs.
+REMOVE_THREADS = 8
+REMOVE_BATCH = 256
+# 'ask' prompts before removing (and doesn't remove when there is no
+# terminal), 'yes' always removes, 'no' never does.
+REMOVE_POLICIES = {'ask', 'yes', 'no'}
+
+ENCODERS = {
+    'opus': encoderprofile('opus', '.opus', OPUS_QUALITY,
+        lambda q, o: ['opusenc', '--quiet', '--ignorelength', '--bitrate', q, '-', o],
+        threads=1, bitrate=lambda q: float(q)),
+    'nero': encoderprofile('nero', '.m4a', AAC_QUALITY,
+        lambda q, o: ['neroAacEnc', '-q', q, '-ignorelength', '-if', '-', '-of', o],
+        threads=1, bitrate=lambda q: float(q) * 380 - 29), # 0.25: ~66kbps, 0.30: ~85kbps
+    'fdkaac': encoderprofile('fdkaac', '.m4a', FDKAAC_QUALITY,
+        lambda q, o: ['fdkaac', '--silent', '--ignorelength', '-m', q, '-o', o, '-'],
+        threads=1, bitrate=lambda q: interpolate([(1, 64), (2, 80), (3, 112), (4, 144), (5, 224)], q)),
+    'ffmpeg-aac': encoderprofile('ffmpeg-aac', '.m4a', FFMPEG_AAC_QUALITY,
+        lambda q, o: ['ffmpeg', '-nostdin', '-loglevel', 'error', '-y', '-i', '-', '-vn', '-c:a', 'aac', '-b:a', q, '-f', 'ipod', o],
+        threads=1, bitrate=lambda q: ffmpegBitrate(q)),
+    'lame': encoderprofile('lame', '.mp3', LAME_QUALITY,
+        lambda q, o: ['lame', '--quiet', '--add-id3v2', '-V', q, '-', o],
+        threads=1, bitrate=lambda q: interpolate([(0, 245), (1, 225), (2, 190), (3, 175), (4, 165), (5, 130), (6, 115), (7, 100), (8, 85), (9, 65)], q)),
+    'vorbis': encoderprofile('vorbis', '.ogg', VORBIS_QUALITY,
+        lambda q, o: ['oggenc', '--quiet', '--ignorelength', '-q', q, '-o', o, '-'],
+        threads=1, bitrate=lambda q: interpolate([(-1, 45), (0, 64), (1, 80), (2, 96), (3, 112), (4, 128), (5, 160), (6, 192), (7, 224), (8, 256), (9, 320), (10, 500)], q)),
+}
+
+# encoder to use when only lossy_ext is given
+DEFAULT_ENCODERS = {
+    '.opus': 'opus',
+    '.m4a':  'nero',
+    '.mp3':  'lame',
+    '.ogg':  'vorbis',
+}
+
+# Decoding MP3 and FLAC is cheap compared to encoding and the decoder mostly
+# waits for the encoder to read its output, so it doesn't count as a thread.
+DECODERS = {
+    # XXX --no-resync?
+    '.mp3':  decoderprofile('mpg123', lambda i: ['mpg123', '--quiet', '-w', '-', i], strict=True, threads=0),
+    '.flac': decoderprofile('flac', lambda i: ['flac', '-dcs', i], strict=False, threads=0),
+}
 
 class MusicSync:
     ''' Copies new files from one source to a destination, possibly transcoding
         them (at least when they are lossless). Removes all files that aren't in
         the source. Updates files changed at one of the two places.
     '''
-    def __init__ (self, source, dest, exclude=(), excludeTranscode=(), lossy_ext=LOSSY_EXT, minimum_transcode_bitrate=MINIMUM_TRANSCODE_BITRATE, confirmRemove=True):
+    def __init__ (self, source, dest, exclude=(), excludeTranscode=(), lossy_ext=None, minimum_transcode_bitrate=MINIMUM_TRANSCODE_BITRATE, confirmRemove=True, encoder=None, quality=None, listeners=None, removePolicy=None, maxRemoveFiles=None, maxRemoveBytes=None, removeManifest=REMOVE_MANIFEST, include=None):
         self.source = source.rstrip('/')+'/'
         self.dest = dest.rstrip('/')+'/'
         self.exclude = exclude
+        # Source files and directories to sync (e.g. from
+        # Library.includePaths()), or None to sync everything.
+        self.include = None
+        if include is not None:
+            self.include = set(map(lambda p: p.rstrip('/'), include))
         self.excludeTranscode = excludeTranscode
-        self.lossy_ext = lossy_ext
+        self.encoder = getEncoder(encoder, lossy_ext)
+        self.quality = quality or self.encoder.quality
+        self.lossy_ext = self.encoder.ext
         self.minimum_transcode_bitrate = minimum_transcode_bitrate
-        self.confirmRemove = confirmRemove
+        if removePolicy is None:
+            removePolicy = 'ask' if confirmRemove else 'yes'
+        if removePolicy not in REMOVE_POLICIES:
+            raise ValueError('unknown remove policy: ' + removePolicy)
+        self.removePolicy = removePolicy
+        # safety budget: don't remove anything when more would be removed
+        self.maxRemoveFiles = maxRemoveFiles
+        self.maxRemoveBytes = maxRemoveBytes
+        self.removeManifest = removeManifest
         self.fileDb = None
         self.artistDb = None
+        # Callables receiving every event as a dict, see emit(). By default
+        # progress is printed to stdout.
+        if listeners is None:
+            listeners = [ProgressPrinter()]
+        self.listeners = list(listeners)
+        self.eventLock = threading.Lock()
+
+    def emit(self, event, **fields):
+        ''' Send an event to all listeners. Safe to call from worker threads. '''
+        fields['event'] = event
+        fields['time'] = time.time()
+        with self.eventLock:
+            for listener in self.listeners:
+                listener(fields)
+
+    def log(self, *args):
+        ''' Replacement for print() that goes through the event stream. '''
+        self.emit('log', message=' '.join(map(str, args)))
 
     def sync(self):
         self.musicDirs = {} # directories containing music
@@ -92,7 +190,7 @@ class MusicSync:
                     elif fn in files:
                         files.remove(fn)
                     else:
-                        print ('Ignored filename not found:', fn)
+                        self.log('Ignored filename not found:', fn)
             dirs.sort()
             files.sort()
             for fn in files:
@@ -118,9 +216,9 @@ class MusicSync:
                 fulldir = os.path.join(base, reldir)
                 if reldir in self.musicDirs:
                     if self.musicDirs[reldir] != fulldir:
-                        print ('Duplicate dir!')
-                        print ('dir 1:', self.musicDirs[reldir])
-                        print ('dir 2:', fulldir)
+                        self.log('Duplicate dir!')
+                        self.log('dir 1:', self.musicDirs[reldir])
+                        self.log('dir 2:', fulldir)
                         # get rid of this warning
                         #self.musicDirs[reldir] = fulldir
                         continue
@@ -138,6 +236,12 @@ class MusicSync:
             self.loadDB()
         return self.fileDb
 
+    def getLibrary(self):
+        ''' Return a Library for querying the Rhythmbox database, projecting
+            sizes with the encoder settings and exclusions of this destination.
+        '''
+        return Library(self.getArtistDB(), self.source, self.encoder, self.quality, self.minimum_transcode_bitrate, self.exclude, self.excludeTranscode)
+
     def loadDB(self):
         self.artistDb = {}
         self.fileDb = {}
@@ -183,14 +287,17 @@ class MusicSync:
             if not 'duration' in properties:
                 # This is likely an invalid file (e.g. Rhythmbox thinks a PNG
                 # image is a music file).
-                print('Unknown duration:', relpath)
+                self.log('Unknown duration:', relpath)
                 continue
             duration = int(properties['duration'])
             bitrate = None
             if 'bitrate' in properties:
                 bitrate = int(properties['bitrate'])
 
-            info = fileinfo(relpath, st, duration, bitrate)
+            playcount = int(properties.get('play-count') or 0)
+            rating = float(properties.get('rating') or 0)
+
+            info = fileinfo(relpath, st, duration, bitrate, playcount, rating)
 
             if artist not in self.artistDb:
                 self.artistDb[artist] = {}
@@ -199,18 +306,25 @@ class MusicSync:
             self.artistDb[artist][album].append(info)
             self.fileDb[path] = info
 
+    def isIncluded(self, path):
+        if self.include is None:
+            return True
+        # check the path and all parent directories
+        while path not in {'', '/'}:
+            if path in self.include:
+                return True
+            path = os.path.dirname(path)
+        return False
+
     def mayCopy(self, path):
-        for nc in self.exclude:
-            if (path+'/').startswith(nc.rstrip('/')+'/'):
-                return False
-        return True
+        return self.isIncluded(path) and mayCopy(path, self.exclude)
 
     def addSeen (self, trackpath, srcpath):
         ''' Mark file as seen '''
         if trackpath in self.seenFiles:
-            print ('Duplicate!')
-            print ('path1:', self.seenFiles[trackpath])
-            print ('path2:', srcpath)
+            self.log('Duplicate!')
+            self.log('path1:', self.seenFiles[trackpath])
+            self.log('path2:', srcpath)
             return True # error
 
         self.seenFiles[trackpath] = srcpath
@@ -255,16 +369,16 @@ class MusicSync:
                     # check whether the source path got replaced
                     if not os.path.samefile(path, destpath):
                         if os.stat(path).st_mtime + 2 >= os.stat(destpath).st_mtime:
-                            print ('replaced:', path)
+                            self.log('replaced:', path)
                             os.remove(destpath)
                             os.link(path, destpath)
                         else:
-                            print ('replaced dest:', path)
+                            self.log('replaced dest:', path)
                             os.remove(path)
                             os.link(destpath, path)
                     continue
                 self.ensureDir(destpath)
-                print ('new:', destpath)
+                self.log('new:', destpath)
                 os.link(path, destpath)
 
 
@@ -315,7 +429,7 @@ class MusicSync:
             for tag in tags:
                 if tags[tag] != dst.get(tag):
                     if log:
-                        print ('changed: %s (%r => %r)' % (tag, dst.get(tag), tags[tag]))
+                        self.log('changed: %s (%r => %r)' % (tag, dst.get(tag), tags[tag]))
                     dst[tag] = tags[tag]
                     changed = True
 
@@ -329,11 +443,20 @@ class MusicSync:
                     try:
                         map(int, tags[tag][0])
                     except ValueError:
-                        print('not a valid BPM value for MP4:', tags[tag])
+                        self.log('not a valid BPM value for MP4:', tags[tag])
                         continue
                 if tag in mutagen.easymp4.EasyMP4.Set and tags[tag] != dst.get(tag):
                     if log:
-                        print ('changed: %s (%r => %r)' % (tag, dst.get(tag), tags[tag]))
+                        self.log('changed: %s (%r => %r)' % (tag, dst.get(tag), tags[tag]))
+                    dst[tag] = tags[tag]
+                    changed = True
+        elif dstExt == '.mp3':
+            # lame is run with --add-id3v2, so there is always a tag to load
+            dst = mutagen.easyid3.EasyID3(dstFile)
+            for tag in tags:
+                if tag in mutagen.easyid3.EasyID3.valid_keys and tags[tag] != dst.get(tag):
+                    if log:
+                        self.log('changed: %s (%r => %r)' % (tag, dst.get(tag), tags[tag]))
                     dst[tag] = tags[tag]
                     changed = True
         elif dstExt in {'.ogg', '.oga'}:
@@ -359,13 +482,13 @@ class MusicSync:
                     continue
                 if tags[tag] != dst.get(tag.upper()):
                     if log:
-                        print ('  changed: %s (%r => %r)' % (tag, dst.get(tag), tags[tag]))
+                        self.log('  changed: %s (%r => %r)' % (tag, dst.get(tag), tags[tag]))
                     dst[tag.upper()] = tags[tag]
                     changed = True
             for tag in dst:
                 if not tag.lower() in tags:
                     if log:
-                        print ('  deleted: %s (%r)' % (tag, dst.get(tag)))
+                        self.log('  deleted: %s (%r)' % (tag, dst.get(tag)))
                     del dst[tag]
                     changed = True
         else:
@@ -373,7 +496,7 @@ class MusicSync:
 
         if changed:
             if log:
-                print ('cp tags:', dstFile)
+                self.log('cp tags:', dstFile)
             dst.save()
 
     def findOld(self):
@@ -388,7 +511,7 @@ class MusicSync:
                 elif n in files:
                     files.remove(n)
                 else:
-                    print('Ignored file not found:', n)
+                    self.log('Ignored file not found:', n)
 
             for fn in files:
                 path      = os.path.join(directory, fn)
@@ -413,21 +536,155 @@ class MusicSync:
     def mayClearOld(self, paths):
         # first remove all old files
         if paths:
-            print ('Files to remove:')
-            for path in paths:
-                print (' * ', path)
-            if not self.confirmRemove or input('Remove [y/N]? ').strip().lower() == 'y':
-                for path in paths:
-                    # file could have been removed in the meantime
-                    if os.path.isfile(path):
-                        os.remove(path)
-                    else:
-                        print ('Gone:\t' + path)
-                print ('Removing done.')
-            else:
+            entries = self.statRemovals(paths)
+            total_bytes = sum(map(lambda e: e['size'], entries))
+
+            if (self.maxRemoveFiles is not None and len(entries) > self.maxRemoveFiles) or \
+                    (self.maxRemoveBytes is not None and total_bytes > self.maxRemoveBytes):
+                self.log('Not removing %d files (%dMB): over the safety budget' % (len(entries), total_bytes/1024/1024))
+                self.emit('remove-abort', reason='budget', files=len(entries), bytes=total_bytes,
+                    max_files=self.maxRemoveFiles, max_bytes=self.maxRemoveBytes)
+                return
+
+            policy = self.removePolicy
+            asked = False
+            if policy == 'ask' and not sys.stdin.isatty():
+                # nobody to answer the question
+                policy = 'no'
+            if policy == 'ask':
+                asked = True
+                print ('Files to remove:')
+                for entry in entries:
+                    print (' * ', entry['path'])
+                if input('Remove [y/N]? ').strip().lower() == 'y':
+                    policy = 'yes'
+
+            if policy != 'yes':
+                self.log('Not removing %d files (%dMB)' % (len(entries), total_bytes/1024/1024))
+                self.emit('remove-abort', reason='policy', files=len(entries), bytes=total_bytes,
+                    policy=self.removePolicy, asked=asked)
                 # do not remove empty directories when the answer is no
                 return
 
+            self.removeFiles(entries)
+
+        self.removeEmptyDirs()
+
+    def statRemovals(self, paths):
+        ''' Return a manifest entry for every path that still exists, with
+            enough information to restore it from the source if possible.
+        '''
+        run = time.time()
+
+        def statBatch(batch):
+            entries = []
+            for path in batch:
+                try:
+                    st = os.lstat(path)
+                except FileNotFoundError:
+                    continue
+                relpath = os.path.relpath(path, self.dest)
+                entry = {
+                    'run': run,
+                    'dest': self.dest,
+                    'path': path,
+                    'size': st.st_size,
+                    'source': None,
+                }
+                # Hard links to the source can be restored by linking them
+                # again.
+                source = os.path.join(self.source, relpath)
+                try:
+                    srcst = os.stat(source)
+                except OSError:
+                    pass
+                else:
+                    if (srcst.st_dev, srcst.st_ino) == (st.st_dev, st.st_ino):
+                        entry['source'] = source
+                entries.append(entry)
+            return entries
+
+        with ThreadPoolExecutor(REMOVE_THREADS) as pool:
+            return [entry for entries in pool.map(statBatch, batches(paths, REMOVE_BATCH)) for entry in entries]
+
+    def removeFiles(self, entries):
+        ''' Unlink the entries in parallel batches, recording the removed
+            files in the removal manifest after every batch.
+        '''
+        total_bytes = sum(map(lambda e: e['size'], entries))
+        self.log('Removing %d files (%dMB)' % (len(entries), total_bytes/1024/1024))
+        self.emit('remove-start', files=len(entries), bytes=total_bytes)
+
+        manifest = None
+        manifestLock = threading.Lock()
+        if self.removeManifest is not None:
+            os.makedirs(os.path.dirname(self.removeManifest), exist_ok=True)
+            manifest = open(self.removeManifest, 'a')
+
+        def removeBatch(batch):
+            removed = []
+            gone = []
+            for entry in batch:
+                try:
+                    os.remove(entry['path'])
+                except FileNotFoundError:
+                    # file could have been removed in the meantime
+                    gone.append(entry['path'])
+                else:
+                    removed.append(entry)
+                    self.emit('remove', path=entry['path'], size=entry['size'], source=entry['source'])
+            if manifest is not None and removed:
+                # only files this run actually removed, so that undoRemove()
+                # doesn't restore files that were already gone
+                with manifestLock:
+                    for entry in removed:
+                        manifest.write(json.dumps(entry) + '\n')
+                    manifest.flush()
+            return gone
+
+        start = time.time()
+        try:
+            with ThreadPoolExecutor(REMOVE_THREADS) as pool:
+                gone = [path for paths in pool.map(removeBatch, batches(entries, REMOVE_BATCH)) for path in paths]
+        finally:
+            if manifest is not None:
+                manifest.close()
+        for path in gone:
+            self.log('Gone:\t' + path)
+        self.log('Removing done.')
+        self.emit('remove-finish', files=len(entries) - len(gone), gone=len(gone), bytes=total_bytes, elapsed=time.time() - start)
+
+    def undoRemove(self, run=None):
+        ''' Restore files removed from this destination (by default in the last
+            run) by linking them again from the source, where it still exists.
+            Returns the number of restored files.
+        '''
+        if self.removeManifest is None or not os.path.isfile(self.removeManifest):
+            return 0
+        entries = []
+        for line in open(self.removeManifest, 'r'):
+            entry = json.loads(line)
+            if entry['dest'] == self.dest:
+                entries.append(entry)
+        if run is None and entries:
+            run = entries[-1]['run']
+
+        restored = 0
+        for entry in entries:
+            if entry['run'] != run:
+                continue
+            if entry['source'] is None or not os.path.isfile(entry['source']):
+                self.log('Cannot restore:', entry['path'])
+                continue
+            if os.path.lexists(entry['path']):
+                continue
+            self.ensureDir(entry['path'])
+            os.link(entry['source'], entry['path'])
+            self.log('restored:', entry['path'])
+            restored += 1
+        return restored
+
+    def removeEmptyDirs(self):
         # now remove empty dirs
         # It's a bit redundant, but it's the easiest option and shouldn't have
         # such a performance impact
@@ -449,7 +706,7 @@ class MusicSync:
                     if e.errno != errno.ENOTEMPTY:
                         raise # some other error
                 else:
-                    print ('removed empty dir:', path)
+                    self.log('removed empty dir:', path)
 
 
     def convertLossless(self):
@@ -476,8 +733,7 @@ class MusicSync:
         if not files:
             return
 
-        print ('\nTo convert: %dMB FLAC' % (total_bytes/1024/1024))
-        self.transcodeAll(files)
+        self.transcodeAll(files, 'FLAC', total_bytes)
 
 
     def transcodeLossy(self):
@@ -489,8 +745,7 @@ class MusicSync:
         if not files:
             return
 
-        print ('\nTo convert: %dMB MP3' % (total_bytes/1024/1024))
-        self.transcodeAll(files)
+        self.transcodeAll(files, 'MP3', total_bytes)
 
     def getAllMP3s(self, path=None, files=None):
         mp3files = {}
@@ -557,65 +812,142 @@ class MusicSync:
         return files, total_bytes
 
     def mayTranscode(self, path):
-        for nt in self.exclude:
-            if path.startswith(nt):
-                return False
-        for nt in self.excludeTranscode:
-            if path.startswith(nt):
-                return False
-        return True
+        return self.isIncluded(path) and mayTranscode(path, self.exclude, self.excludeTranscode)
 
-    def transcodeAll(self, files):
+    def transcodeAll(self, files, kind, total_bytes):
         if not files:
             return
 
         duration_total = sum(map(lambda o: o['duration'], files.values()))
-        duration_started = 0
-        current_durations = []
+
+        # Threads a single job keeps busy: the decoder runs alongside the
+        # encoder.
+        decoderThreads = 0
+        for path in files:
+            ext = os.path.splitext(path)[1].lower()
+            if ext in DECODERS:
+                decoderThreads = max(decoderThreads, DECODERS[ext].threads)
+        jobThreads = self.encoder.threads + decoderThreads
+
+        # Start with as many jobs as fit on the CPUs, then let the calibrator
+        # find out whether the encoder benefits from more (e.g. when it's I/O
+        # bound or the decoder takes a significant share).
+        initial = max(1, MAXPROCS // max(1, jobThreads))
+        calibrator = Calibrator(initial, max(initial, MAXPROCS * 2))
+        slots = threading.Condition()
+        running = 0
+
+        # aggregate statistics, protected by slots
+        totals = {
+            'files_total': len(files),
+            'files_started': 0,
+            'files_done': 0,
+            'files_skipped': 0,
+            'files_failed': 0,
+            'duration_total': duration_total,
+            'duration_done': 0,
+            'bytes_in': 0,
+            'bytes_out': 0,
+            'decode_time': 0,
+            'encode_time': 0,
+        }
+
+        def snapshot():
+            with slots:
+                elapsed = time.time() - start
+                speed = totals['duration_done'] / max(elapsed, 0.001)
+                remaining_time = None
+                if speed:
+                    remaining_time = (duration_total - totals['duration_done']) / speed
+                return dict(totals,
+                    kind=kind,
+                    elapsed=elapsed,
+                    speed=speed,
+                    remaining_time=remaining_time,
+                    running=running,
+                    queue_depth=len(files) - totals['files_started'],
+                    jobs=calibrator.limit)
 
         def worker(queue):
+            nonlocal running
             while True:
                 task = queue.get()
                 if task is None:
                     break
+                with slots:
+                    while running >= calibrator.limit:
+                        slots.wait()
+                    running += 1
+                    totals['files_started'] += 1
+                    depth = len(files) - totals['files_started']
+                    level = calibrator.admit()
+                    jobStart = time.time()
                 queue.task_done()
                 inpath, outpath = task
-                self.transcodeFile(inpath, outpath)
+                duration = files[inpath]['duration']
+                self.emit('file-start', path=inpath, outpath=outpath, duration=duration, queue_depth=depth)
+                result = None
+                skipped = False
+                try:
+                    result = self.transcodeFile(inpath, outpath)
+                except SkipFile as e:
+                    skipped = True
+                    reason = str(e)
+                except Exception as e:
+                    fields = {}
+                    if getattr(e, 'stderr', None):
+                        fields['stderr'] = e.stderr.decode(errors='replace')
+                    self.emit('file-error', path=inpath, outpath=outpath, error=str(e), **fields)
+                    raise
+                finally:
+                    elapsed = time.time() - jobStart
+                    with slots:
+                        running -= 1
+                        if result is not None:
+                            calibrator.record(level, duration, elapsed)
+                        else:
+                            calibrator.drop(level)
+                        if skipped:
+                            totals['files_skipped'] += 1
+                        elif result is None:
+                            totals['files_failed'] += 1
+                        else:
+                            totals['files_done'] += 1
+                            totals['duration_done'] += duration
+                            for key in ['bytes_in', 'bytes_out', 'decode_time', 'encode_time']:
+                                totals[key] += result[key]
+                        slots.notify_all()
+                if result is None:
+                    self.emit('file-skip', path=inpath, outpath=outpath, error=reason)
+                else:
+                    self.emit('file-finish', path=inpath, outpath=outpath,
+                        duration=duration,
+                        elapsed=elapsed,
+                        realtime=duration / max(elapsed, 0.001),
+                        **result)
 
         queue = Queue(1)
         start = time.time()
+        self.emit('transcode-start', kind=kind, files=len(files), bytes=total_bytes, duration=duration_total, jobs=calibrator.limit)
 
         threads = []
-        for i in range(MAXPROCS):
+        for i in range(calibrator.maximum):
             t = threading.Thread(target=worker, args=(queue,))
             t.daemon = True
             t.start()
             threads.append(t)
 
-        # transcode all MP3s
-        statusLine = ''
-        for path in sorted(files.keys()):
-            properties = files[path]
-            outpath = properties['outpath']
+        stopped = threading.Event()
+        def snapshotter():
+            while not stopped.wait(SNAPSHOT_INTERVAL):
+                self.emit('snapshot', **snapshot())
+        snapshotThread = threading.Thread(target=snapshotter)
+        snapshotThread.daemon = True
+        snapshotThread.start()
 
-            queue.put([path, outpath], block=True)
+        for path in sorted(files.keys()):
+            queue.put([path, files[path]['outpath']], block=True)
             queue.join()
-            print (' '*len(statusLine)+'\r'+path)
-
-            duration_started += properties['duration']
-            current_durations = (current_durations + [properties['duration']])[-4:]
-
-            now = time.time()
-
-            # approximate how much of the durations is finished
-            duration_done = duration_started - sum(current_durations[math.ceil(len(current_durations)/2):])
-
-            speed = duration_done/(now-start) # music-seconds per time-second
-            remaining_time = (duration_total-duration_done)/speed
-            percent = duration_done*100/duration_total
-            statusLine = '%.2f%% %dx (remaining: %d:%02d)' % (percent, speed, remaining_time//60, remaining_time%60)
-            print (statusLine, end='\r')
-            sys.stdout.flush()
 
         for i in range(len(threads)):
             queue.put(None, block=True)
@@ -624,61 +956,64 @@ class MusicSync:
         for t in threads:
             t.join()
 
-        total_time = time.time()-start
-        avg_speed  = duration_total/total_time
-        # this also overwrites the progress indicator
-        print ('\rFinished in %d:%02d (avg. speed %.1fx)' % (total_time//60, total_time%60, avg_speed))
+        stopped.set()
+        snapshotThread.join()
+
+        self.emit('transcode-finish', **snapshot())
 
     def transcodeFile(self, inpath, outpath):
+        ''' Transcode a single file. Returns statistics about the job, or raises
+            SkipFile when the file was skipped (locked or failed to decode).
+        '''
         if not outpath.endswith(self.lossy_ext):
             raise ValueError('Unrecognized output file: ' + outpath)
 
+        ext = os.path.splitext(inpath)[1].lower()
+        if ext not in DECODERS:
+            raise RuntimeError('unknown input file type: '+inpath)
+        profile = DECODERS[ext]
+
         infile = open(inpath, 'a')
         try:
             lockf(infile, LOCK_EX|LOCK_NB)
         except IOError as e:
             if e.errno == errno.EWOULDBLOCK:
                 infile.close()
-                return
+                raise SkipFile('locked by another process')
             raise
 
         destpath = outpath[:-len(self.lossy_ext)]
 
         tmppath = outpath + '.part'
 
-        wavpath = tmpname(os.path.basename(inpath + '.wav'))
-
         try:
-            if inpath.lower().endswith('.mp3'):
-                # decode MP3
-                # XXX --no-resync?
-                output = subprocess.check_output(['mpg123', '--quiet', '-w', wavpath, inpath], stderr=subprocess.STDOUT)
-                if output:
-                    sys.stderr.write(output.decode())
-                    if os.path.isfile(wavpath):
-                        os.remove(wavpath)
-                    lockf(infile, LOCK_UN)
-                    infile.close()
-                    return
-            elif inpath.lower().endswith('.flac'):
-                if subprocess.call(['flac', '-fds', inpath, '-o', wavpath]):
-                    if os.path.isfile(wavpath):
-                        os.remove(wavpath)
-                    lockf(infile, LOCK_UN)
-                    infile.close()
-            else:
-                raise RuntimeError('unknown input file type: '+inpath)
-
             parentdir = os.path.dirname(destpath)
             os.makedirs(parentdir, exist_ok=True)
 
-            # Transcode!
-            if self.lossy_ext == '.opus':
-                subprocess.check_call(['opusenc', '--bitrate', OPUS_QUALITY, wavpath, tmppath], stderr=PIPE)
-            elif self.lossy_ext == '.m4a':
-                subprocess.check_call(['neroAacEnc', '-q', AAC_QUALITY, '-if', wavpath, '-of', tmppath], stderr=PIPE)
-            else:
-                raise RuntimeError('unknown output file type: '+self.lossy_ext)
+            # Transcode! The decoder is piped straight into the encoder.
+            decoder = Decoder(profile, inpath, PIPE)
+            encodeStart = time.time()
+            try:
+                enc = Popen(self.encoder.command(self.quality, tmppath), stdin=decoder.stdout, stderr=PIPE)
+            except:
+                # e.g. the encoder isn't installed: don't leave the decoder
+                # blocked on a full pipe
+                decoder.stdout.close()
+                decoder.proc.kill()
+                decoder.finish()
+                raise
+            decoder.stdout.close() # so the decoder gets SIGPIPE if the encoder dies
+            _, encerr = enc.communicate()
+            encodeTime = time.time() - encodeStart
+            decoded, decodeErrors = decoder.finish()
+            # A failing encoder also makes the decoder fail (SIGPIPE), so check
+            # the encoder first: that's an error, not a skip.
+            if enc.returncode:
+                raise subprocess.CalledProcessError(enc.returncode, enc.args, stderr=encerr)
+            if not decoded:
+                raise SkipFile(decodeErrors or '%s exited with status %d' % (profile.name, decoder.proc.returncode))
+            if decodeErrors:
+                self.log('%s: %s' % (profile.name, decodeErrors))
 
             # copy tags
             self.copyTags(inpath, tmppath)
@@ -690,23 +1025,487 @@ class MusicSync:
                 # remove bigger and duplicate file
                 os.remove(destpath)
 
-        finally:
-            # remove temporary WAV file - if it's there
-            if os.path.isfile(wavpath):
-                os.remove(wavpath)
+            return {
+                'bytes_in': os.stat(inpath).st_size,
+                'bytes_out': os.stat(outpath).st_size,
+                'decode_time': decoder.duration,
+                'encode_time': encodeTime,
+            }
 
+        finally:
             if os.path.isfile(tmppath):
                 os.remove(tmppath)
 
-        lockf(infile, LOCK_UN)
-        infile.close()
+            lockf(infile, LOCK_UN)
+            infile.close()
+
+class Library:
+    ''' Indexed view of the Rhythmbox database with precomputed totals per
+        artist, album and format, to decide what fits on a device. Projected
+        sizes use the given encoder settings unless others are passed, and
+        follow the exclude and excludeTranscode rules of MusicSync.
+    '''
+    def __init__(self, artistDb, source, encoder=None, quality=None, minimum_transcode_bitrate=MINIMUM_TRANSCODE_BITRATE, exclude=(), excludeTranscode=()):
+        self.source = source.rstrip('/')+'/'
+        self.encoder = encoder or getEncoder()
+        self.quality = quality or self.encoder.quality
+        self.minimum_transcode_bitrate = minimum_transcode_bitrate
 
-def tmpname(suffix):
-    global tmp_number
+        # (artist, album): [fileinfo]
+        self.albumTracks = {}
+        # (artist, album): [size of tracks that are never transcoded, duration
+        # of lossless tracks, [(bitrate, size, duration) of MP3s]], so
+        # projecting sizes doesn't need to look at every track
+        self.albumParts = {}
+        albums = {}
+        formats = {}
+        for artist, artistAlbums in artistDb.items():
+            for album, tracks in artistAlbums.items():
+                key = (artist, album)
+                self.albumTracks[key] = tracks
+                albums[key] = totals = [0, 0, 0, 0, 0]
+                self.albumParts[key] = parts = [0, 0, []]
+                for info in tracks:
+                    ext = os.path.splitext(info.relpath)[1].lower()
+                    addTrack(totals, info)
+                    addTrack(formats.setdefault(ext, [0, 0, 0, 0, 0]), info)
+                    path = self.source + info.relpath
+                    if not mayCopy(path, exclude):
+                        # not synced at all
+                        continue
+                    if ext in LOSSLESSFORMATS:
+                        parts[1] += info.duration
+                    elif ext == '.mp3' and mayTranscode(path, exclude, excludeTranscode):
+                        parts[2].append((info.bitrate or 0, info.stat.st_size, info.duration))
+                    else:
+                        parts[0] += info.stat.st_size
+
+        # roll album totals up to artists and the whole library
+        artists = {}
+        total = [0, 0, 0, 0, 0]
+        for (artist, album), totals in albums.items():
+            addTotals(artists.setdefault(artist, [0, 0, 0, 0, 0]), totals)
+            addTotals(total, totals)
+
+        self.albumStats  = {key: makeStats(totals) for key, totals in albums.items()}
+        self.artistStats = {key: makeStats(totals) for key, totals in artists.items()}
+        self.formatStats = {key: makeStats(totals) for key, totals in formats.items()}
+        self.total = makeStats(total)
+
+        # caches: {(encoder, quality, minimum bitrate): {album: bytes}} and
+        # {order: [album]}
+        self.projections = {}
+        self.rankings = {}
+        # {directory: set of albums with tracks in or below it}, built by
+        # includePaths()
+        self.dirAlbums = None
+
+    def projectedSizes(self, encoder=None, quality=None, minimum_transcode_bitrate=None):
+        ''' Return the projected destination size in bytes of every album. '''
+        encoder = encoder or self.encoder
+        if isinstance(encoder, str):
+            encoder = getEncoder(encoder)
+        if quality is None:
+            quality = self.quality if encoder is self.encoder else encoder.quality
+        minimum = minimum_transcode_bitrate
+        if minimum is None:
+            minimum = self.minimum_transcode_bitrate
+
+        key = (encoder.name, quality, minimum)
+        if key not in self.projections:
+            bytesPerSecond = encoder.bitrate(quality) * 1000 / 8
+            sizes = {}
+            for album, (fixedSize, losslessDuration, mp3s) in self.albumParts.items():
+                duration = losslessDuration
+                size = fixedSize
+                for bitrate, mp3size, mp3duration in mp3s:
+                    # see getAllMP3s and getHighBitrateMP3s
+                    if minimum == 0 or (bitrate and bitrate >= minimum):
+                        duration += mp3duration
+                    else:
+                        size += mp3size
+                sizes[album] = int(size + duration * bytesPerSecond)
+            self.projections[key] = sizes
+        return self.projections[key]
+
+    def projectedSize(self, encoder=None, quality=None, minimum_transcode_bitrate=None):
+        ''' Return the projected size in bytes of the whole library. '''
+        return sum(self.projectedSizes(encoder, quality, minimum_transcode_bitrate).values())
+
+    def ranking(self, order):
+        ''' Return all albums sorted by the given libstats field, highest first. '''
+        if order not in libstats._fields:
+            raise ValueError('unknown album order: ' + order)
+        if order not in self.rankings:
+            self.rankings[order] = sorted(self.albumStats, key=lambda album: getattr(self.albumStats[album], order), reverse=True)
+        return self.rankings[order]
+
+    def selectAlbums(self, limit=None, maxBytes=None, order='playcount', where=None, encoder=None, quality=None, minimum_transcode_bitrate=None):
+        ''' Select up to limit albums in the given order, skipping albums that
+            would exceed maxBytes on the destination. where(album, stats) may
+            filter albums further. Returns a list of (artist, album) tuples.
+        '''
+        sizes = self.projectedSizes(encoder, quality, minimum_transcode_bitrate)
+        selected = []
+        total = 0
+        for album in self.ranking(order):
+            if limit is not None and len(selected) >= limit:
+                break
+            if where is not None and not where(album, self.albumStats[album]):
+                continue
+            size = sizes[album]
+            if maxBytes is not None and total + size > maxBytes:
+                continue
+            selected.append(album)
+            total += size
+        return selected
+
+    def includePaths(self, albums):
+        ''' Return the source paths of the given albums, usable as the include
+            set of MusicSync. A directory is included as a whole (with its
+            covers) only when all music files in and below it on disk are
+            tracks of the selected albums, so that nothing else gets synced.
+            Otherwise the tracks and covers are listed one by one.
+        '''
+        if self.dirAlbums is None:
+            self.dirAlbums = {}
+            for album, tracks in self.albumTracks.items():
+                for info in tracks:
+                    directory = os.path.dirname(info.relpath)
+                    while True:
+                        self.dirAlbums.setdefault(directory, set()).add(album)
+                        if not directory:
+                            break
+                        directory = os.path.dirname(directory)
+
+        selected = set(albums)
+        selectedTracks = set()
+        for album in selected:
+            for info in self.albumTracks[album]:
+                selectedTracks.add(info.relpath)
+
+        # {directory: whether it only holds selected tracks}
+        whole = {}
+        def onlySelected(directory):
+            if not self.dirAlbums[directory] <= selected:
+                return False
+            # The database may not know every file (e.g. tracks without a
+            # duration), so check what is actually there.
+            for dirpath, dirs, files in os.walk(self.source + directory):
+                for fn in files:
+                    if os.path.splitext(fn)[1].lower() not in MUSICFORMATS:
+                        continue
+                    if os.path.relpath(os.path.join(dirpath, fn), self.source) not in selectedTracks:
+                        return False
+            return True
+
+        paths = set()
+        for album in selected:
+            for info in self.albumTracks[album]:
+                directory = os.path.dirname(info.relpath)
+                if directory not in whole:
+                    whole[directory] = onlySelected(directory)
+                if whole[directory]:
+                    paths.add((self.source + directory).rstrip('/'))
+                else:
+                    paths.add(self.source + info.relpath)
+                    for cover in COVERS:
+                        paths.add(os.path.join(self.source, directory, cover))
+        return paths
+
+class SkipFile(Exception):
+    ''' Raised by MusicSync.transcodeFile when a file is skipped, with the
+        reason as message.
+    '''
+
+class Calibrator:
+    ''' Tunes the number of concurrent transcode jobs. It measures throughput
+        (music-seconds per second) over the first few jobs started at each level
+        and adds a job as long as that improves throughput noticeably, falling
+        back to the best level otherwise.
+
+        Throughput at a level is the speed of a single job (music-seconds per
+        second of job time) times the number of jobs running at once, so it
+        doesn't depend on when jobs happen to finish. The first jobs of a level
+        start while jobs of the previous level are still finishing, so they
+        aren't measured.
+    '''
+    def __init__(self, initial, maximum):
+        self.limit = initial
+        self.maximum = maximum
+        self.best = None # (throughput, limit)
+        self.done = initial >= maximum
+        self.level = 0
+        self.resetLevel()
+
+    def resetLevel(self):
+        self.level += 1
+        self.levelStarted = 0
+        self.levelMeasuring = 0 # measured jobs that haven't finished yet
+        self.levelJobs = 0
+        self.levelDuration = 0
+        self.levelElapsed = 0
+
+    def levelSize(self):
+        return max(CALIBRATE_JOBS, 2 * self.limit)
+
+    def admit(self):
+        ''' Call when a job starts. Returns a token to pass to record(), which
+            is None when the job isn't measured.
+        '''
+        if self.done:
+            return None
+        self.levelStarted += 1
+        if self.levelStarted <= self.limit:
+            return None
+        # Keep measuring new jobs until enough of them were recorded, as
+        # measured jobs may be dropped.
+        if self.levelJobs + self.levelMeasuring >= self.levelSize():
+            return None
+        self.levelMeasuring += 1
+        return self.level
+
+    def drop(self, level):
+        ''' Call instead of record() when a job was skipped or failed, as it
+            says nothing about throughput.
+        '''
+        if self.done or level != self.level:
+            return
+        self.levelMeasuring -= 1
+
+    def record(self, level, duration, elapsed):
+        ''' Record a finished job of the given duration (in music-seconds)
+            that took elapsed seconds.
+        '''
+        if self.done or level != self.level:
+            # not measured, or started at a previous level
+            return
+        self.levelMeasuring -= 1
+        self.levelJobs += 1
+        self.levelDuration += duration
+        self.levelElapsed += elapsed
+        if self.levelJobs < self.levelSize():
+            return
 
-    # due to the GIL, we don't have to care about atomicity
-    tmp_number += 1
-    return '%s/musicsync-%d-%s' % (TMPDIR, tmp_number, suffix)
+        throughput = self.levelDuration / max(self.levelElapsed, 0.001) * self.limit
+        if self.best is None or throughput > self.best[0] * CALIBRATE_GAIN:
+            self.best = (throughput, self.limit)
+            if self.limit >= self.maximum:
+                self.done = True
+                return
+            self.limit += 1
+            self.resetLevel()
+        else:
+            self.limit = self.best[1]
+            self.done = True
+
+class Decoder:
+    ''' A running decoder process, writing WAV to stdout (usually a PIPE).
+    '''
+    def __init__(self, profile, inpath, stdout):
+        self.profile = profile
+        self.errfile = tempfile.TemporaryFile()
+        self.start = time.time()
+        self.end = None
+        self.proc = Popen(profile.command(inpath), stdout=stdout, stderr=self.errfile)
+        self.stdout = self.proc.stdout
+        # Reap the process as soon as it exits, so that the decode time is
+        # known even when it runs in a pipeline.
+        self.waiter = threading.Thread(target=self.wait)
+        self.waiter.daemon = True
+        self.waiter.start()
+
+    def wait(self):
+        self.proc.wait()
+        self.end = time.time()
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    def finish(self):
+        ''' Wait for the decoder to exit. Returns whether it succeeded and what
+            it wrote to stderr.
+        '''
+        self.waiter.join()
+        self.errfile.seek(0)
+        output = self.errfile.read().decode(errors='replace').strip()
+        self.errfile.close()
+        return self.proc.returncode == 0 and not (output and self.profile.strict), output
+
+class ProgressPrinter:
+    ''' Event listener printing log messages and transcode progress for humans,
+        with a status line that is overwritten as the transcode progresses.
+    '''
+    def __init__(self, out=None):
+        self.out = out or sys.stdout
+        self.statusLine = ''
+        self.start = None
+        self.durationTotal = 0
+        self.durationDone = 0
+        self.jobs = 0
+
+    def __call__(self, event):
+        kind = event['event']
+        if kind == 'log':
+            self.write(event['message'])
+        elif kind == 'transcode-start':
+            self.start = event['time']
+            self.durationTotal = event['duration']
+            self.durationDone = 0
+            self.jobs = event['jobs']
+            self.write('\nTo convert: %dMB %s' % (event['bytes']/1024/1024, event['kind']))
+        elif kind == 'remove':
+            self.write('removed: ' + event['path'])
+        elif kind == 'file-start':
+            self.write(event['path'])
+        elif kind == 'file-skip':
+            self.write('skipped: %s: %s' % (event['path'], event['error']))
+        elif kind == 'file-error':
+            self.write('failed: %s: %s' % (event['path'], event['error']))
+            if 'stderr' in event:
+                self.write(event['stderr'].rstrip('\n'))
+        elif kind == 'file-finish':
+            self.durationDone += event['duration']
+            self.status(event['time'])
+        elif kind == 'snapshot':
+            self.durationDone = event['duration_done']
+            self.jobs = event['jobs']
+            self.status(event['time'])
+        elif kind == 'transcode-finish':
+            total_time = event['elapsed']
+            avg_speed = event['duration_total'] / max(total_time, 0.001)
+            self.clear()
+            self.write('Finished in %d:%02d (avg. speed %.1fx, %d jobs)' % (total_time//60, total_time%60, avg_speed, event['jobs']))
+
+    def write(self, line):
+        self.out.write(' '*len(self.statusLine) + '\r' + line + '\n')
+        if self.statusLine:
+            self.out.write(self.statusLine + '\r')
+        self.out.flush()
+
+    def clear(self):
+        self.out.write(' '*len(self.statusLine) + '\r')
+        self.statusLine = ''
+
+    def status(self, now):
+        speed = self.durationDone/max(now-self.start, 0.001) # music-seconds per time-second
+        if not speed or not self.durationTotal:
+            return
+        remaining_time = (self.durationTotal-self.durationDone)/speed
+        percent = self.durationDone*100/self.durationTotal
+        statusLine = '%.2f%% %dx (remaining: %d:%02d, jobs: %d)' % (percent, speed, remaining_time//60, remaining_time%60, self.jobs)
+        self.out.write(' '*len(self.statusLine) + '\r' + statusLine + '\r')
+        self.out.flush()
+        self.statusLine = statusLine
+
+class JSONEventWriter:
+    ''' Event listener writing every event as a JSON object on its own line,
+        for unattended runs (systemd, cron). Takes a file or file descriptor.
+    '''
+    def __init__(self, out):
+        if isinstance(out, int):
+            out = os.fdopen(out, 'w')
+        self.out = out
+
+    def __call__(self, event):
+        self.out.write(json.dumps(event) + '\n')
+        self.out.flush()
+
+def mayCopy(path, exclude):
+    '''
+    Return whether the source path isn't excluded from syncing.
+    '''
+    for nc in exclude:
+        if (path+'/').startswith(nc.rstrip('/')+'/'):
+            return False
+    return True
+
+def mayTranscode(path, exclude, excludeTranscode):
+    '''
+    Return whether the source path may be transcoded (instead of copied).
+    '''
+    for nt in exclude:
+        if path.startswith(nt):
+            return False
+    for nt in excludeTranscode:
+        if path.startswith(nt):
+            return False
+    return True
+
+def addTrack(totals, info):
+    '''
+    Add a track to a [tracks, size, duration, playcount, rating] list.
+    '''
+    totals[0] += 1
+    totals[1] += info.stat.st_size
+    totals[2] += info.duration
+    totals[3] += info.playcount
+    totals[4] += info.rating
+
+def addTotals(totals, other):
+    for i in range(len(totals)):
+        totals[i] += other[i]
+
+def makeStats(totals):
+    '''
+    Convert a list made by addTrack() to libstats.
+    '''
+    tracks, size, duration, playcount, rating = totals
+    bitrate = 0
+    if duration:
+        bitrate = size * 8 / duration / 1000
+    if tracks:
+        rating /= tracks
+    return libstats(tracks, size, duration, bitrate, playcount, rating)
+
+def batches(items, size):
+    '''
+    Split a list in lists of at most size items.
+    '''
+    return [items[i:i+size] for i in range(0, len(items), size)]
+
+def interpolate(table, quality):
+    '''
+    Estimate the bitrate for a quality setting from a sorted list of
+    (quality, kbps) pairs, interpolating between them.
+    '''
+    q = float(quality)
+    if q <= table[0][0]:
+        return table[0][1]
+    for (q1, kbps1), (q2, kbps2) in zip(table, table[1:]):
+        if q <= q2:
+            return kbps1 + (kbps2 - kbps1) * (q - q1) / (q2 - q1)
+    return table[-1][1]
+
+def ffmpegBitrate(quality):
+    '''
+    Return the bitrate in kbps of an ffmpeg -b:a value ('80k', '1M', '128000').
+    '''
+    quality = quality.strip().lower()
+    if quality.endswith('k'):
+        return float(quality[:-1])
+    if quality.endswith('m'):
+        return float(quality[:-1]) * 1000
+    return float(quality) / 1000
+
+def getEncoder(name=None, ext=None):
+    '''
+    Return the encoder profile by name or, if no name is given, the default
+    encoder for the given extension (LOSSY_EXT if none is given).
+    '''
+    if name is None:
+        if ext is None:
+            ext = LOSSY_EXT
+        if ext not in DEFAULT_ENCODERS:
+            raise ValueError('no encoder for output file type: ' + ext)
+        name = DEFAULT_ENCODERS[ext]
+    if name not in ENCODERS:
+        raise ValueError('unknown encoder: ' + name)
+    encoder = ENCODERS[name]
+    if ext is not None and ext != encoder.ext:
+        raise ValueError('encoder %s produces %s files, not %s' % (name, encoder.ext, ext))
+    return encoder
 
 def getInfo(path):
     return json.loads(subprocess.check_output(['ffprobe', '-loglevel', 'error', '-i', path, '-print_format', 'json', '-show_streams']))